@@ -24,13 +24,23 @@ from vedbus import VeDbusService
 
 path_UpdateIndex = '/UpdateIndex'
 
+# Konstanten fuer _update
+VOLTAGE = 230                   # feste Netzspannung je Phase
+E_OFFSET = 73311                # kWh Zaehlerstand am 12.09.23
+E_SHARE_L1 = 0.576              # Aufteilung der Gesamtenergie auf die Phasen
+E_SHARE_L23 = 0.212             # L2 und L3 je
+
 # MQTT Setup
 broker_address = "192.168.178.58"
 port = 1883
 MQTTNAME = "ehzmeter"
+MQTT_RECONNECT_DELAY = 5        # Sekunden bis zum ersten Reconnect-Versuch
+MQTT_MAX_RECONNECT_DELAY = 120  # Obergrenze, Wartezeit verdoppelt sich pro Fehlversuch
+MQTT_CONNECT_TIMEOUT = 2        # Sekunden, so lange blockiert ein Verbindungsversuch den Mainloop hoechstens
 
 # Variablen setzen
 verbunden = 0
+reconnect_delay = MQTT_RECONNECT_DELAY
 durchlauf = 0
 volt_ges = 0
 volt_p1 = 0
@@ -46,59 +56,127 @@ e_totkwh = 0
 pow_l1 = 0
 pow_l2 = 0
 pow_l3 = 0
+revision = 0  # wird bei jedem neuen Wert fuer dbus erhoeht, siehe _update
 
 # MQTT Abfragen:
 
 def on_disconnect(client, userdata, rc):
     global verbunden
-    print("Client Got Disconnected")
+    verbunden = 0
     if rc != 0:
-        print('Unexpected MQTT disconnection. Will auto-reconnect')
-
+        logging.warning("Unexpected MQTT disconnection (rc=%d), reconnect in %ds", rc, reconnect_delay)
     else:
-        print('rc value:' + str(rc))
+        logging.info("MQTT disconnected, reconnect in %ds", reconnect_delay)
+
+    # nicht hier im Callback blockierend verbinden, sondern aus dem Mainloop heraus
+    schedule_reconnect()
+
+# wie reconnect_delay_set() bei paho's loop_forever: erster Versuch nach
+# MQTT_RECONNECT_DELAY, danach jeweils doppelt so lange bis
+# MQTT_MAX_RECONNECT_DELAY; nur ein erfolgreiches CONNACK (on_connect) setzt
+# die Wartezeit zurueck, auch ein abgelehntes CONNACK zaehlt als Fehlversuch
+def schedule_reconnect():
+    global reconnect_delay
+    gobject.timeout_add_seconds(reconnect_delay, mqtt_reconnect)
+    reconnect_delay = min(reconnect_delay * 2, MQTT_MAX_RECONNECT_DELAY)
 
+def mqtt_reconnect():
+    global verbunden
     try:
-        print("Trying to Reconnect")
-        client.connect(broker_address)
+        logging.info("Connecting to MQTT broker %s:%d", broker_address, port)
+        client.reconnect()
         verbunden = 1
-    except Exception as e:
+    except Exception:
         logging.exception("Fehler beim reconnecten mit Broker")
-        print("Error in Retrying to Connect with Broker")
         verbunden = 0
-        print(e)
-            
+        schedule_reconnect()
+    return False    # Timer beenden, neuer Versuch ist ggf. neu eingeplant
+
 def on_connect(client, userdata, flags, rc):
-    print("Verbunden mit ehzmeter: " + broker_address)
-    client.subscribe("ehzmeter/#")
+    global reconnect_delay
+    if rc == 0:
+        reconnect_delay = MQTT_RECONNECT_DELAY
+    logging.info("Verbunden mit ehzmeter: %s (rc=%d)", broker_address, rc)
+    # Telemetrie: QoS 0, ein verpasster Wert wird wenige Sekunden spaeter ersetzt,
+    # PUBACK-Roundtrips wuerden nur Latenz kosten
+    client.subscribe("ehzmeter/#", qos=0)
+
+
+# Handler je Topic, payload sind die rohen bytes (float() nimmt bytes direkt)
+# wichtig global, sonst werden die globalen variablen nicht aktualisiert
+def on_pvpower(payload):
+    global pow_ges, revision
+    pow_ges = float(payload)
+    revision += 1
 
+def on_pvtoday(payload):
+    global e_today
+    e_today = float(payload)   # value is 0.1 Wh, divide by 10000 for kwh
+
+def on_pvtotal(payload):
+    global e_total, revision
+    e_total = float(payload)   # value is 0.1 Wh, divide by 10000 for kwh
+    revision += 1
+
+def on_pvpwrl123(payload):
+    global pow_l1, pow_l2, pow_l3, revision
+    # "p1,p2,p3" direkt auf den bytes zerlegen; ohne genau drei gueltige Werte
+    # gibt es einen ValueError, bevor etwas gespeichert oder revision erhoeht wird
+    str_l1, str_l2, str_l3 = payload.split(b",")
+    l1, l2, l3 = float(str_l1), float(str_l2), float(str_l3)
+    pow_l1, pow_l2, pow_l3 = l1, l2, l3
+    revision += 1
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug("powl123: %s %s %s", pow_l1, pow_l2, pow_l3)
+
+topic_handlers = {
+    "ehzmeter/pvpower": on_pvpower,
+    "ehzmeter/pvtoday": on_pvtoday,
+    "ehzmeter/pvtotal": on_pvtotal,
+    "ehzmeter/pvpwrl123": on_pvpwrl123,
+}
 
 def on_message(client, userdata, message):
-#wichtig global, sonst werden die globalen variablen nicht aktualisiert
-    global volt_ges,volt_p1, volt_p2, volt_p3, amp_p1, amp_p2, amp_p3, pow_ges, e_total, e_today,pow_l1,pow_l2,pow_l3
-
-    msg = str(message.payload.decode("utf-8"))
-    print("message received: ", msg)
-    print("message topic: ", message.topic)
-    if message.topic == "ehzmeter/pvpower":
-        pow_ges = float(msg)   
-    elif message.topic == "ehzmeter/pvtoday":
-        e_today = float(msg)   # value is 0.1 Wh, divide by 10000 for kwh
-    elif message.topic == "ehzmeter/pvtotal":
-        e_total = float(msg)   # value is 0.1 Wh, divide by 10000 for kwh
-    elif message.topic == "ehzmeter/pvpwrl123":
-        str_l1, str_l2, str_l3 = msg.split(",")  # for comma-separated inputs
-        pow_l1 = float(str_l1)
-        pow_l2 = float(str_l2)
-        pow_l3 = float(str_l3)
-        print("powl123: ",pow_l1,pow_l2,pow_l3)
+    # Formatierung nur, wenn DEBUG auch wirklich ausgegeben wird
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug("message received: %s %r", message.topic, message.payload)
+    handler = topic_handlers.get(message.topic)
+    if handler is not None:   # andere ehzmeter/# Topics ignorieren
+        # on_message laeuft im io_add_watch von mqtt_read; eine Exception wuerde
+        # dort den Watch beenden und danach nichts mehr empfangen
+        try:
+            handler(message.payload)
+        except ValueError:
+            logging.warning("Ungueltiger Wert auf %s ignoriert: %r", message.topic, message.payload)
+
+# Pfade, die _update bei jedem Durchlauf schreibt. compute_values liefert
+# die Werte in genau dieser Reihenfolge, beide nur gemeinsam aendern.
+UPDATE_PATHS = (
+    '/Ac/Energy/Forward',
+    '/Ac/L1/Voltage', '/Ac/L2/Voltage', '/Ac/L3/Voltage',
+    '/Ac/L1/Energy/Forward', '/Ac/L2/Energy/Forward', '/Ac/L3/Energy/Forward',
+    '/Ac/L1/Current', '/Ac/L2/Current', '/Ac/L3/Current',
+    '/Ac/L1/Power', '/Ac/L2/Power', '/Ac/L3/Power',
+    '/Ac/Power')
+
+# Reine Float-Arithmetik ohne Zugriff auf globals/dbus; bei 10 s Takt lohnt
+# sich hier kein JIT (numba), die Laufzeit liegt im Mikrosekundenbereich.
+def compute_values(e_totkwh, p_ges, l1, l2, l3):
+    e_l23 = round((e_totkwh * E_SHARE_L23),1)
+    return (
+        round((e_totkwh),1),                                # /Ac/Energy/Forward
+        VOLTAGE, VOLTAGE, VOLTAGE,                          # /Ac/Lx/Voltage
+        round((e_totkwh * E_SHARE_L1),1), e_l23, e_l23,     # /Ac/Lx/Energy/Forward
+        round(l1/VOLTAGE,1), round(l2/VOLTAGE,1), round(l3/VOLTAGE,1),  # /Ac/Lx/Current
+        round(l1,1), round(l2,1), round(l3,1),              # /Ac/Lx/Power
+        round(p_ges))                                       # /Ac/Power
 
 class DbusDummyService2:
   def __init__(self, servicename, deviceinstance, paths, productname='SMAL1 HM L1 L2 L3', connection='MQTT'):
     self._dbusservice = VeDbusService(servicename)
     self._paths = paths
 
-    logging.debug("%s /DeviceInstance = %d" % (servicename, deviceinstance))
+    logging.debug("%s /DeviceInstance = %d", servicename, deviceinstance)
 
     # Create the management objects, as specified in the ccgx dbus-api document
     self._dbusservice.add_path('/Mgmt/ProcessName', __file__)
@@ -118,38 +196,58 @@ class DbusDummyService2:
       self._dbusservice.add_path(
         path, settings['initial'], writeable=True, onchangecallback=self._handlechangedvalue)
 
+    # die Items aus UPDATE_PATHS, die _update bei jedem Durchlauf schreibt,
+    # einmal nachschlagen.
+    # Achtung: _update ist eine Kopie von vedbus' ServiceContext.__setitem__/flush
+    # und nutzt dessen Interna VeDbusService._dbusobjects, _dbusnodes['/']
+    # (ItemsChanged) und VeDbusItemExport._local_set_value; nach einem
+    # velib_python-Update gegen ServiceContext pruefen
+    items = self._dbusservice._dbusobjects
+    self._update_items = tuple((path, items[path]) for path in UPDATE_PATHS)
+    self._index_item = items[path_UpdateIndex]
+    self._root = self._dbusservice._dbusnodes['/']
+    self._last_revision = -1  # erster Durchlauf schreibt immer
+
     gobject.timeout_add(10000, self._update) # pause 10000ms before the next request
 
   # /Ac/Energy/Forward is in kwh, 73311 is the offset of the total energy at begin of 12.09.23
   def _update(self):
-    e_totkwh = e_total/10000 - 73311
-    self._dbusservice['/Ac/Energy/Forward'] = round((e_totkwh),1)
-    self._dbusservice['/Ac/L1/Voltage'] = 230
-    self._dbusservice['/Ac/L2/Voltage'] = 230
-    self._dbusservice['/Ac/L3/Voltage'] = 230
-    self._dbusservice['/Ac/L1/Energy/Forward'] = round((e_totkwh * 0.576),1)
-    self._dbusservice['/Ac/L2/Energy/Forward'] = round((e_totkwh * 0.212),1)
-    self._dbusservice['/Ac/L3/Energy/Forward'] = round((e_totkwh * 0.212),1)
-    self._dbusservice['/Ac/L1/Current'] = round(pow_l1/230,1)
-    self._dbusservice['/Ac/L2/Current'] = round(pow_l2/230,1)
-    self._dbusservice['/Ac/L3/Current'] = round(pow_l3/230,1)
-    self._dbusservice['/Ac/L1/Power'] = round(pow_l1,1)
-    self._dbusservice['/Ac/L2/Power'] = round(pow_l2,1)
-    self._dbusservice['/Ac/L3/Power'] = round(pow_l3,1)
-    self._dbusservice['/Ac/Power'] = round(pow_ges)
-    
-    logging.info("PV Power: {:.0f}".format(pow_ges))
-    logging.info("PV Energy: {:.4f}".format(e_totkwh))
-    
+    # keine neuen MQTT-Werte seit dem letzten Durchlauf: nichts zu senden,
+    # auch /UpdateIndex bleibt stehen
+    if revision == self._last_revision:
+      return True
+    self._last_revision = revision
+
+    # on_message laeuft im selben Mainloop, die globalen Werte koennen sich
+    # hier nicht aendern
+    e_totkwh = e_total/10000 - E_OFFSET
+    values = compute_values(e_totkwh, pow_ges, pow_l1, pow_l2, pow_l3)
+    # zip() wuerde bei ungleicher Laenge stillschweigend abschneiden
+    assert len(values) == len(self._update_items)
+
+    # alle Aenderungen sammeln und als ein einziges ItemsChanged-Signal senden
+    # statt einem PropertiesChanged pro Pfad (wie ServiceContext in vedbus.py)
+    changes = {}
+    for (path, item), value in zip(self._update_items, values):
+      c = item._local_set_value(value)
+      if c is not None:
+        changes[path] = c
+
     # increment UpdateIndex - to show that new data is available
-    index = self._dbusservice[path_UpdateIndex] + 1  # increment index
+    index = self._index_item.local_get_value() + 1  # increment index
     if index > 255:   # maximum value of the index
       index = 0       # overflow from 255 to 0
-    self._dbusservice[path_UpdateIndex] = index
+    changes[path_UpdateIndex] = self._index_item._local_set_value(index)
+
+    if changes:   # wie ServiceContext.flush
+      self._root.ItemsChanged(changes)
+
+    logging.info("PV Power: %.0f", pow_ges)
+    logging.info("PV Energy: %.4f", e_totkwh)
     return True
 
   def _handlechangedvalue(self, path, value):
-    logging.debug("someone else updated %s to %s" % (path, value))
+    logging.debug("someone else updated %s to %s", path, value)
     return True # accept the change
 
 def main():
@@ -181,18 +279,63 @@ def main():
       path_UpdateIndex: {'initial': 0},
     })
 
+  # MQTT erst hier starten, damit der Import des Moduls weder Netzwerk noch
+  # logging anfasst; ein logging-Aufruf vor basicConfig wuerde implizit
+  # basicConfig mit WARNING ausfuehren und alle INFO-Meldungen verschlucken.
+  # connect_async setzt nur die Parameter, verbunden wird ueber mqtt_reconnect,
+  # damit ein beim Start nicht erreichbarer Broker das Script nicht beendet
+  client.connect_async(broker_address, port)
+  mqtt_reconnect()
+  gobject.timeout_add_seconds(1, mqtt_misc)
+
   logging.info('Connected to dbus, and switching over to gobject.MainLoop() (= event based)')
   mainloop = gobject.MainLoop()
   mainloop.run()
 
+# MQTT ohne eigenen Netzwerk-Thread: der Broker-Socket wird im selben
+# gobject-Mainloop wie dbus ueberwacht, dadurch laufen on_message und _update
+# immer im gleichen Thread
+mqtt_watches = {}
+
+def on_socket_open(client, userdata, sock):
+    mqtt_watches['read'] = gobject.io_add_watch(sock, gobject.IO_IN | gobject.IO_HUP | gobject.IO_ERR, mqtt_read)
+
+def on_socket_close(client, userdata, sock):
+    for key in list(mqtt_watches):
+        gobject.source_remove(mqtt_watches.pop(key))
+
+def on_socket_register_write(client, userdata, sock):
+    mqtt_watches['write'] = gobject.io_add_watch(sock, gobject.IO_OUT, mqtt_write)
+
+def on_socket_unregister_write(client, userdata, sock):
+    if 'write' in mqtt_watches:
+        gobject.source_remove(mqtt_watches.pop('write'))
+
+def mqtt_read(source, condition):
+    client.loop_read()
+    return 'read' in mqtt_watches   # watch ist weg, wenn der Socket geschlossen wurde
+
+def mqtt_write(source, condition):
+    client.loop_write()
+    return 'write' in mqtt_watches
+
+def mqtt_misc():
+    client.loop_misc()  # keepalive ping und timeouts
+    return True
+
 # Konfiguration MQTT
 client = mqtt.Client(MQTTNAME) # create new instance
 client.on_disconnect = on_disconnect
 client.on_connect = on_connect
 client.on_message = on_message
-client.connect(broker_address, port)  # connect to broker
-
-client.loop_start()
+client.on_socket_open = on_socket_open
+client.on_socket_close = on_socket_close
+client.on_socket_register_write = on_socket_register_write
+client.on_socket_unregister_write = on_socket_unregister_write
+# client.reconnect() verbindet blockierend im Mainloop (dbus steht solange);
+# paho >= 1.6 nimmt _connect_timeout (Standard 5 s) als Timeout fuer
+# socket.create_connection, aeltere Versionen stattdessen den keepalive (60 s)
+client._connect_timeout = MQTT_CONNECT_TIMEOUT
 
 if __name__ == "__main__":
   main()
\ No newline at end of file